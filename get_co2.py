@@ -1,46 +1,193 @@
 # import necessary packages
+import os
+import io
+import functools
+import warnings
+import urllib.request
+from datetime import datetime, timedelta
+
+import numpy as np
 import pandas as pd
 
+# numba is optional, fall back to pandas groupby without it
+try:
+  from numba import njit
+except ImportError:
+  njit = None
+
 # plotting packages
+# render without probing for a gui backend, the figure is only saved
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib import patches
 from matplotlib import font_manager
 from matplotlib import rcParams
 
 # set constants
-NOAA_URL = "ftp://aftp.cmdl.noaa.gov/products/trends/co2/co2_trend_gl.csv"
+NOAA_URL = "https://gml.noaa.gov/webdata/ccgg/trends/co2/co2_trend_gl.csv"
+# local copy of the noaa csv and how long it stays fresh
+CACHE_PATH = os.path.expanduser("~/.cache/carbot/co2_trend_gl.csv")
+CACHE_MAX_AGE = timedelta(hours=12)
+# csv parser, 'pandas' or 'pyarrow' (multithreaded, needs pyarrow installed)
+CSV_ENGINE = os.environ.get('CARBOT_CSV_ENGINE', 'pandas')
+# columns to parse from the noaa csv and their types
+NOAA_DTYPES = {'year': 'int16', 'month': 'int8', 'day': 'int8',
+               'smoothed': 'float32', 'trend': 'float32'}
 # number of rows to skip in noaa csv
 SKIPROWS = 60
 # number of years to plot
 NUMBER_OF_YEARS = 10
+# directories with the fonts used in the plot
+FONT_DIRS = ['/Users/tushar/Library/Fonts']
+
+# where the daily figures are saved
+FIGURE_DIR = 'figures'
+
+
+def _monthly_mean(year, month, x):
+  '''mean of x over each run of equal (year, month), broadcast back to every row'''
+  out = np.empty_like(x)
+  total = 0.0
+  count = 0
+  prev = -1
+  start = 0
+  for i in range(len(x)):
+    key = year[i] * 12 + month[i]
+    if key != prev and i > 0:
+      out[start:i] = total / count
+      total = 0.0
+      count = 0
+      start = i
+    prev = key
+    total += x[i]
+    count += 1
+  if count > 0:
+    out[start:] = total / count
+  return out
+
+
+if njit is not None:
+  _monthly_mean = njit(cache=True)(_monthly_mean)
+
+
+def monthly_mean(data, column):
+  '''monthly mean of a column on a sorted datetime index'''
+  if njit is None:
+    return data[column].groupby(data.index.to_period('M')).transform('mean')
+  values = _monthly_mean(data.index.year.values.astype('int64'),
+                         data.index.month.values.astype('int64'),
+                         data[column].values)
+  return pd.Series(values, index=data.index)
+
+
+def read_noaa_csv(source, skiprows):
+  '''parse only the needed columns of the noaa csv'''
+  if CSV_ENGINE == 'pyarrow':
+    # pyarrow is optional, only imported when asked for
+    try:
+      import pyarrow
+      import pyarrow.csv as pv
+    except ImportError:
+      warnings.warn("CARBOT_CSV_ENGINE is 'pyarrow' but pyarrow is not installed, using pandas")
+    else:
+      table = pv.read_csv(source,
+                          read_options=pv.ReadOptions(skip_rows=skiprows),
+                          convert_options=pv.ConvertOptions(
+                            include_columns=list(NOAA_DTYPES),
+                            column_types={k: pyarrow.type_for_alias(v) for k, v in NOAA_DTYPES.items()}))
+      return table.to_pandas()
+  elif CSV_ENGINE != 'pandas':
+    warnings.warn(f"unknown CARBOT_CSV_ENGINE {CSV_ENGINE!r}, using pandas")
+  return pd.read_csv(source, skiprows=skiprows, usecols=list(NOAA_DTYPES),
+                     dtype=NOAA_DTYPES, engine='c')
+
+
+def fetch_cached(url, path, skiprows, max_age=CACHE_MAX_AGE):
+  '''read csv from the local cache, downloading it again if stale or missing'''
+
+  # use the cached copy if it is recent enough
+  try:
+    mtime = datetime.fromtimestamp(os.stat(path).st_mtime)
+    if datetime.now() - mtime < max_age:
+      return read_noaa_csv(path, skiprows)
+  except FileNotFoundError:
+    pass
+
+  # download into memory, then write the cache atomically
+  with urllib.request.urlopen(url) as response:
+    buffer = io.BytesIO(response.read())
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = path + ".tmp"
+  with open(tmp_path, 'wb') as f:
+    f.write(buffer.getbuffer())
+  os.replace(tmp_path, path)
 
+  return read_noaa_csv(buffer, skiprows)
 
-def get_noaa_data(url, skiprows, number_of_years):
+
+def get_noaa_data(url, skiprows, number_of_years, today):
   '''download, clean noaa data and compute statistics'''
 
-  # get data from NOAA website
-  data = pd.read_csv(url, skiprows=skiprows)
+  # get data from NOAA website (cached locally)
+  data = fetch_cached(url, CACHE_PATH, skiprows)
 
   # clean data
   # create datetime index and drop extra columns
-  data.set_index(pd.to_datetime(data.iloc[:, 0:3]), inplace=True)
-  data.drop(['year', 'month', 'day'], axis=1, inplace=True)
+  year = data['year'].to_numpy('int64')
+  month = data['month'].to_numpy('int64')
+  day = data['day'].to_numpy('int64')
+  months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+  data.index = pd.DatetimeIndex(months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]'))
+  data = data[['smoothed', 'trend']].copy()
 
-  # compute monthly ppm averages
-  data['monthly_mean'] = data.groupby(pd.Grouper(freq='M'))['smoothed'].mean()
+  # compute monthly ppm averages, kept only on the last day of each month
+  data['monthly_mean'] = monthly_mean(data, 'smoothed').where(data.index.is_month_end)
 
   # select the desired number of years
-  end_date = pd.Timestamp.today().date() # today
+  end_date = today.date()
   start_date = end_date.replace(year=end_date.year - number_of_years)
-  data = data.loc[start_date:end_date,:].copy()
+  start = data.index.searchsorted(np.datetime64(start_date))
+  data = data.iloc[start:]
 
-  yesterday = data.iloc[-1,:]
-  year_ago = data.iloc[-366,:]
+  # latest reading and the reading closest to a year before it
+  last_date = data.index[-1]
+  target = last_date - pd.DateOffset(years=1)
+  year_ago_pos = min(data.index.searchsorted(target), len(data) - 1)
+  # the reading before may be nearer if the feed has a gap at the target
+  if year_ago_pos > 0 and target - data.index[year_ago_pos - 1] < data.index[year_ago_pos] - target:
+    year_ago_pos -= 1
+  yesterday = data.iloc[-1]
+  year_ago = data.iloc[year_ago_pos]
   
   return data, start_date, end_date, yesterday, year_ago
 
 
-def plot(data, start_date, end_date, yesterday, year_ago):
+@functools.lru_cache(maxsize=1)
+def _load_fonts():
+  '''add every font in FONT_DIRS to matplotlib'''
+  for font in font_manager.findSystemFonts(FONT_DIRS):
+    # use font_manager.FontProperties(fname=font).get_name() to get the name
+    font_manager.fontManager.addfont(font)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_data(today):
+  '''noaa data for the given day, reused within the same process'''
+  return get_noaa_data(NOAA_URL, SKIPROWS, NUMBER_OF_YEARS, today)
+
+
+def figure_path(today):
+  '''path of today's figure'''
+  return os.path.join(FIGURE_DIR, today.strftime('%Y-%m-%d') + '.png')
+
+
+def plot(data, start_date, end_date, yesterday, year_ago, today):
+  # today's figure was already made
+  outfile = figure_path(today)
+  if os.path.exists(outfile):
+    return
+
   # figure settings
   title_size = 35
   subtitle_size = 30
@@ -65,25 +212,29 @@ def plot(data, start_date, end_date, yesterday, year_ago):
   rcParams['grid.color'] = "#F7F7F7"
   rcParams['axes.labelsize'] = 20
   rcParams['figure.figsize'] = (14, 10)
-  rcParams['figure.dpi'] = 300
+  rcParams['figure.dpi'] = 100
+  save_dpi = 300
 
   month_marker = "o" # circle
+  trend_points = 400 # the trend is smooth, so this many points is enough
   
-  # Add every font at the specified location
-  font_dir = ['/Users/tushar/Library/Fonts']
-  for font in font_manager.findSystemFonts(font_dir):
-    # use font_manager.FontProperties(fname=font).get_name() to get the name
-    font_manager.fontManager.addfont(font)
+  # Add every font at the specified location, once per process
+  _load_fonts()
 
   # make the figure
   fig, ax = plt.subplots()
 
   # mean values
-  ax.plot(data.index, data['monthly_mean'], markersize=month_size, marker=month_marker,
-          markeredgecolor=month_color, markerfacecolor='none', markeredgewidth=month_marker_width)
+  # only month-end rows hold a mean, so draw just those points
+  monthly = data['monthly_mean'].dropna()
+  ax.scatter(monthly.index.values, monthly.values, s=month_size**2, marker=month_marker,
+             facecolors='none', edgecolors=month_color, linewidths=month_marker_width)
 
-  # trend
-  ax.plot(data.index, data['trend'], c=trend_color, linewidth=trend_size)
+  # trend, decimated by a stride that always keeps the latest point
+  step = max(1, len(data) // trend_points)
+  trend_pos = np.arange(len(data) - 1, -1, -step)[::-1]
+  ax.plot(data.index.values[trend_pos], data['trend'].values[trend_pos],
+          c=trend_color, linewidth=trend_size)
 
   # daily values
   ax.plot(yesterday.name, yesterday['smoothed'], c=highlight_color,
@@ -92,9 +243,6 @@ def plot(data, start_date, end_date, yesterday, year_ago):
           markersize=highlight_size, marker=month_marker)
 
   # curves
-  xlims = ax.get_xlim()
-  ylims = ax.get_ylim()
-
   arrow = patches.ArrowStyle.CurveB(head_length=30, head_width=12)
   curve1 = patches.FancyArrowPatch(posA=(yesterday.name - pd.Timedelta(365*0.7, 'days'), yesterday['smoothed'] - 14.5),
                                    posB=(yesterday.name, yesterday['smoothed'] - 1),
@@ -107,26 +255,24 @@ def plot(data, start_date, end_date, yesterday, year_ago):
                                    color=highlight_color, linewidth=highlight_width,
                                    arrowstyle=arrow)
 
-  #ax.autoscale(False)
+  # fix the limits to the plotted data first, so the arrows don't widen the view
+  ax.autoscale_view()
+  ax.autoscale(False)
   ax.add_patch(curve1)
   ax.add_patch(curve2)
   
   # tick labels
   tick_font = font_manager.FontProperties(family='Roboto Mono')
-  for label in ax.get_yticklabels() :
-      label.set_fontproperties(tick_font)
-  ax.tick_params(axis='y', labelsize=label_size)
-  for label in ax.get_xticklabels() :
-      label.set_fontproperties(tick_font)
-  ax.tick_params(axis='x', labelsize=label_size)
+  plt.setp(ax.get_xticklabels() + ax.get_yticklabels(), fontproperties=tick_font)
+  ax.tick_params(axis='both', labelsize=label_size)
   ax.tick_params(left=False)
 
   # text
   ax.text(yesterday.name - pd.Timedelta(365*1.8, 'days'), yesterday['smoothed'] - 17.5,
-          s="Yesterday:\n" + str(round(yesterday['smoothed'], 2)) + " ppm", fontsize=label_size,
+          s=f"Yesterday:\n{yesterday['smoothed']:.2f} ppm", fontsize=label_size,
           fontstyle='italic', fontfamily='Overpass', color=text_color)
   ax.text(year_ago.name - pd.Timedelta(365*4.2, 'days'), year_ago['smoothed'],
-          s="One year ago:\n" + str(round(year_ago['smoothed'], 2)) + " ppm", fontsize=label_size,
+          s=f"One year ago:\n{year_ago['smoothed']:.2f} ppm", fontsize=label_size,
           fontstyle='italic', fontfamily='Overpass', color=text_color)
 
   # clear spines
@@ -144,14 +290,23 @@ def plot(data, start_date, end_date, yesterday, year_ago):
   ax.text(s="Atmospheric CO$_{2}$, parts per million", fontsize=subtitle_size, y=1.07,
           x=-0.06, transform=ax.transAxes, fontfamily='Overpass', fontweight=400)
   ax.text(s=("Source: NOAA/ESRL | Graphic: Tushar Khurana (credit: Clayton Aldern) | Generated: " +
-             pd.Timestamp.today().strftime('%B %d, %Y')), fontsize=caption_size, y=-0.12,
+             today.strftime('%B %d, %Y')), fontsize=caption_size, y=-0.12,
           x=-0.06, transform=ax.transAxes, fontstyle='italic', fontfamily='Overpass', color=text_color)
 
-  # create filename and save
-  filename = pd.Timestamp.today().strftime('%Y-%m-%d')
-  fig.savefig('figures/' + filename + '.jpg', bbox_inches='tight', pad_inches=0.4)  
+  # save
+  fig.savefig(outfile, bbox_inches='tight', pad_inches=0.4, dpi=save_dpi,
+              pil_kwargs={'compress_level': 1})
+
+
+def main():
+  '''make today's figure unless it already exists'''
+  now = pd.Timestamp.today()
+  if os.path.exists(figure_path(now)):
+    return
+  # keyed on the day so reruns in the same process reuse the data
+  data, start_date, end_date, yesterday, year_ago = _load_data(now.normalize())
+  plot(data, start_date, end_date, yesterday, year_ago, now)
 
 
 if __name__ == "__main__":
-  data, start_date, end_date, yesterday, year_ago = get_noaa_data(NOAA_URL, SKIPROWS, NUMBER_OF_YEARS)
-  plot(data, start_date, end_date, yesterday, year_ago)
\ No newline at end of file
+  main()